@@ -1,24 +1,34 @@
-import os
+from types import MappingProxyType
 
-def detect_language(file_path):
-    ext_to_lang = {
-        ".py": "Python",
-        ".js": "JavaScript",
-        ".ts": "TypeScript",
-        ".java": "Java",
-        ".c": "C",
-        ".cpp": "C++",
-        ".cs": "C#",
-        ".go": "Go",
-        ".rb": "Ruby",
-        ".php": "PHP",
-        ".rs": "Rust",
-        ".swift": "Swift",
-        ".kt": "Kotlin",
-        ".html": "HTML",
-        ".css": "CSS",
-        ".sh": "Shell",
-        ".sql": "SQL"
-    }
-    ext = os.path.splitext(file_path)[1]
-    return ext_to_lang.get(ext, "txt")
+# Mapping file extensions (lowercase) to languages, shared by all review scripts.
+EXT_TO_LANG = MappingProxyType({
+    ".py": "Python",
+    ".js": "JavaScript",
+    ".ts": "TypeScript",
+    ".java": "Java",
+    ".c": "C",
+    ".cpp": "C++",
+    ".cc": "C++",
+    ".cxx": "C++",
+    ".h": "C++",
+    ".hpp": "C++",
+    ".cs": "C#",
+    ".go": "Go",
+    ".rb": "Ruby",
+    ".php": "PHP",
+    ".rs": "Rust",
+    ".swift": "Swift",
+    ".kt": "Kotlin",
+    ".html": "HTML",
+    ".css": "CSS",
+    ".sh": "Shell",
+    ".sql": "SQL"
+})
+
+# Look up the language by suffix without os.path.splitext; binding the dict's get method as a
+# default argument makes it a fast local lookup.
+def detect_language(file_path, *, _get=EXT_TO_LANG.get):
+    dot = file_path.rfind(".")
+    if dot < 0:
+        return "Unknown"
+    return _get(file_path[dot:].lower(), "Unknown")
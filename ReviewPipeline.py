@@ -1,18 +1,30 @@
-def ai_code_review(file_path):
+import asyncio
+import ollama
+from DetectFile import detect_language
+
+# Shared async Ollama client used by ai_code_review.
+client = ollama.AsyncClient()
+
+def read_file(file_path):
+    with open(file_path, "r", encoding="utf-8", errors="replace") as f:
+        return f.read()
+
+async def ai_code_review(file_path):
     language = detect_language(file_path)
-    with open(file_path, "r") as f:
-        code_content = f.read()
+    code_content = await asyncio.to_thread(read_file, file_path)
 
-    prompt = f"""
-    Review the following {language} code based on these rules:
+    # Rules go in a system message that is identical for every file of a language, with the
+    # code last, so successive prompts share a cacheable prefix.
+    system_prompt = f"""
+    Review the {language} code sent by the user based on these rules:
 
     {get_language_rules(language)}
-
-    Code:
-    {code_content}
     """
 
-    response = ollama.chat(model="<your-model>", messages=[{"role": "user", "content": prompt}])
+    response = await client.chat(model="<your-model>", messages=[
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": code_content},
+    ])
     return response['message']['content']
 
 def get_language_rules(language):
@@ -28,7 +40,6 @@ def get_language_rules(language):
         "PHP": "Ensure strict_types, detect SQL injection, check for CSRF protection.",
         "Rust": "Follow ownership and borrowing rules, avoid unsafe blocks, optimize memory usage.",
         "Swift": "Use guard statements, enforce explicit access control, avoid force-unwrapping.",
-        "SQL": "Optimize queries, ensure proper indexing, avoid SQL injection.",
-        "txt": "No specific rules available."
+        "SQL": "Optimize queries, ensure proper indexing, avoid SQL injection."
     }
     return rules_dict.get(language, "No specific rules available.")
@@ -1,19 +1,51 @@
 import os
+import asyncio
+import collections
+import hashlib
 import json
+import logging
+import queue
 import subprocess
 import sys
 import re
-import git
+import shutil
+import tempfile
+import urllib.request
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
+from DetectFile import EXT_TO_LANG, detect_language
+import httpx
 import ollama
+import orjson
+import pathspec
 
 # -------------------------------
 # Helper Functions
 # -------------------------------
 
+logger = logging.getLogger("code_review")
+
+THINK_RE = re.compile(r"<think>.*?</think>", re.DOTALL)
+
 # Clean the AI output by removing <think> tags.
 def clean_ai_output(text):
-    return re.sub(r"<think>.*?</think>", "", text, flags=re.DOTALL).strip()
+    if "<think>" not in text:
+        return text.strip()
+    return THINK_RE.sub("", text).strip()
+
+# Number of review workers, i.e. files in progress (and Ollama requests in flight) at once.
+# Defaults to OLLAMA_NUM_PARALLEL so the client never queues more work than the server has
+# parallel slots for.
+REVIEW_CONCURRENCY = int(os.getenv("REVIEW_CONCURRENCY", os.getenv("OLLAMA_NUM_PARALLEL", "8")))
+
+# Shared async Ollama client used by all review coroutines, so every request reuses the same
+# keep-alive connection pool. It is closed at the end of main().
+# Start the Ollama server with OLLAMA_NUM_PARALLEL set (e.g. OLLAMA_NUM_PARALLEL=4)
+# so concurrent requests are served in parallel instead of being queued.
+client = ollama.AsyncClient(
+    host=os.getenv("OLLAMA_HOST", "http://localhost:11434"),
+    limits=httpx.Limits(max_keepalive_connections=REVIEW_CONCURRENCY),
+)
 
 # Load repository path from input argument.
 if len(sys.argv) < 2:
@@ -23,69 +55,271 @@ REPO_PATH = sys.argv[1]
 
 # Load rules from rules.json.
 def load_rules():
-    with open("rules.json", "r") as file:
-        return json.load(file)
+    with open("rules.json", "rb") as file:
+        return orjson.loads(file.read())
 RULES = load_rules()
 
-# Mapping file extensions to languages.
-EXT_TO_LANG = {
-    ".cpp": "C++",
-    ".cc": "C++",
-    ".cxx": "C++",
-    ".h": "C++",
-    ".hpp": "C++"
-    # Add other extensions for other languages if needed.
+MODEL = "deepseek-r1:8b"
+
+# Pre-format each language's rules once so the per-file hot path is a dict lookup.
+FORMATTED_RULES = {
+    language: "\n\n".join(
+        f"{category}:\n" + "\n".join(f"- {rule}" for rule in rules_list)
+        for category, rules_list in language_rules.items()
+    )
+    for language, language_rules in RULES.items()
+}
+
+# System prompt for each language. It is identical for every file of that language and sent
+# before the code, so the server can reuse the KV cache for this prefix across files.
+SYSTEM_PROMPTS = {
+    language: f"""
+Review the {language} code sent by the user based on following rules and nothing more.
+Return a JSON object with exactly these keys: {json.dumps(list(language_rules))}.
+The value of each key must list the violations of that category's rules found in the code.
+
+Rules:
+{FORMATTED_RULES[language]}
+"""
+    for language, language_rules in RULES.items()
 }
 
-def detect_language(file_path):
-    ext = os.path.splitext(file_path)[1]
-    return EXT_TO_LANG.get(ext, "Unknown")
+# Persistent review cache, keyed by a hash of (model, language, system prompt, analyzers, code).
+# Only entries used during the current run are written back, which keeps the file bounded.
+CACHE_PATH = os.path.join(REPO_PATH, ".review_cache.json")
+
+def load_cache():
+    if not os.path.exists(CACHE_PATH):
+        return {}
+    try:
+        with open(CACHE_PATH, "rb") as file:
+            return orjson.loads(file.read())
+    except (OSError, orjson.JSONDecodeError):
+        return {}
+
+def save_cache(cache):
+    with open(CACHE_PATH, "wb") as file:
+        file.write(orjson.dumps(cache))
+
+# The system prompt (which includes the rules) and the analyzers registered for the language (only
+# installed tools are registered) are part of the key, so changing either invalidates earlier reviews.
+def review_cache_key(language, code_content):
+    prompt_text = SYSTEM_PROMPTS[language]
+    analyzers_text = json.dumps(sorted(
+        [category, cmd, sorted(ok_exit_codes)]
+        for (analyzer_language, category), (cmd, ok_exit_codes, _) in CATEGORY_ANALYZERS.items()
+        if analyzer_language == language
+    ))
+    return hashlib.blake2b(
+        f"{MODEL}|{language}|{prompt_text}|{analyzers_text}|{code_content}".encode()
+    ).hexdigest()
 
-# Get .gitignore patterns.
-def get_gitignore_patterns():
+REVIEW_CACHE = load_cache()
+used_cache = {}
+
+# Only extensions of languages that have rules are collected for review.
+EXT_SET = frozenset(ext.lstrip(".") for ext, language in EXT_TO_LANG.items() if language in RULES)
+
+# Compile .gitignore patterns into a single matcher.
+def get_gitignore_spec():
     gitignore_path = os.path.join(REPO_PATH, ".gitignore")
     if not os.path.exists(gitignore_path):
-        return []
-    patterns = []
+        return pathspec.GitIgnoreSpec.from_lines([])
     with open(gitignore_path, "r") as f:
-        for line in f:
-            line = line.strip()
-            if line and not line.startswith("#"):
-                patterns.append(line)
-    return patterns
-
-# Check if a file should be ignored based on .gitignore patterns.
-def is_ignored(file_path, ignored_patterns):
-    relative_path = os.path.relpath(file_path, REPO_PATH)
-    for pattern in ignored_patterns:
-        # Simple check: if the relative path starts with the pattern (for directories)
-        if pattern.endswith("/") and relative_path.startswith(pattern):
-            return True
-        # For file patterns, check for equality or prefix match.
-        elif relative_path == pattern or relative_path.startswith(pattern):
-            return True
-    return False
-
-# Recursively get all files (ignoring those in .gitignore).
-def get_all_files():
-    ignored_patterns = get_gitignore_patterns()
-    all_files = []
-    for root, _, files in os.walk(REPO_PATH):
-        for file in files:
-            # Skip hidden files.
-            if file.startswith("."):
+        return pathspec.GitIgnoreSpec.from_lines(f)
+
+# Files larger than this are not sent to the model; this keeps prompt size (and prefill time) bounded.
+MAX_FILE_BYTES = int(os.getenv("REVIEW_MAX_FILE_BYTES", "64000"))
+
+# Read a source file; run via asyncio.to_thread so the open+read is a single executor hop.
+# At most MAX_FILE_BYTES + 1 bytes are read, so a file that grew after the directory walk is
+# still detected as oversized without loading it in full.
+def read_file(file_path):
+    with open(file_path, "rb") as f:
+        return f.read(MAX_FILE_BYTES + 1)
+
+# Recursively yield (path, size) of reviewable files under root using os.scandir (no splitext).
+def iter_files(root, spec, rel_root=""):
+    with os.scandir(root) as it:
+        for entry in it:
+            # Skip hidden files and directories.
+            if entry.name.startswith("."):
                 continue
-            file_path = os.path.join(root, file)
-            if detect_language(file_path) != "Unknown" and not is_ignored(file_path, ignored_patterns):
-                all_files.append(file_path)
-    return all_files
+            rel_path = rel_root + entry.name
+            if entry.is_dir(follow_symlinks=False):
+                # Prune ignored directories so their contents are never visited.
+                if not spec.match_file(rel_path + "/"):
+                    yield from iter_files(entry.path, spec, rel_path + "/")
+                continue
+            _, dot, ext = entry.name.rpartition(".")
+            if dot and ext.lower() in EXT_SET and not spec.match_file(rel_path):
+                yield entry.path, entry.stat().st_size
+
+# Group files with identical content (vendored copies, generated headers) so each is reviewed once.
+# Takes and returns (item, size) pairs, where each item is a list of file paths; groups are
+# returned largest first.
+def group_identical_files(files):
+    groups = {}
+    for file_path, size in files:
+        # Oversized files are never reviewed, so they are not read for hashing either.
+        if size > MAX_FILE_BYTES:
+            groups[("oversized", file_path)] = ([file_path], size)
+            continue
+        # file_digest hashes straight from the file descriptor without building a bytes copy.
+        with open(file_path, "rb") as f:
+            digest = hashlib.file_digest(f, lambda: hashlib.blake2b(digest_size=16)).digest()
+        groups.setdefault((detect_language(file_path), digest), ([], size))[0].append(file_path)
+    return sorted(groups.values(), key=lambda item: item[1], reverse=True)
+
+# Recursively get all files (ignoring those in .gitignore) as (path, size) pairs, largest first.
+# Submitting the longest reviews first keeps one big file from holding up the end of the run.
+# The size comes from the directory walk, so no extra stat is needed.
+def get_all_files():
+    return sorted(iter_files(REPO_PATH, get_gitignore_spec()), key=lambda item: item[1], reverse=True)
 
 # -------------------------------
 # AI Review Functions
 # -------------------------------
 
-# Perform AI code review for each category for a given file.
-def ai_code_review_by_category(file_path):
+# Render one JSON item as text; objects such as {"line": 12, "issue": "..."} become "line: 12, issue: ...".
+def format_feedback_item(item):
+    if isinstance(item, dict):
+        return ", ".join(f"{key}: {format_feedback_item(value)}" for key, value in item.items())
+    if isinstance(item, list):
+        return "; ".join(format_feedback_item(value) for value in item)
+    return str(item).strip()
+
+# Convert a single JSON value from the model into Markdown feedback.
+def format_feedback(value):
+    if isinstance(value, list):
+        return "\n".join(f"- {format_feedback_item(item)}" for item in value) or "No issues found."
+    if isinstance(value, dict):
+        return "\n".join(f"- {key}: {format_feedback_item(item)}" for key, item in value.items()) or "No issues found."
+    return str(value).strip() or "No issues found."
+
+# Split a free-form response on category headings (used when the model's output is not valid JSON).
+def split_feedback_by_category(text, categories):
+    heading = re.compile(
+        r"^[#*\s]*(" + "|".join(re.escape(c) for c in categories) + r")\b[^\n]*$",
+        flags=re.MULTILINE | re.IGNORECASE,
+    )
+    parts = heading.split(text)
+    feedback = {}
+    # parts = [preamble, category, body, category, body, ...]
+    for name, body in zip(parts[1::2], parts[2::2]):
+        category = next(c for c in categories if c.lower() == name.lower())
+        feedback[category] = body.strip()
+    if not feedback:
+        return {"General": text}
+    return feedback
+
+# Parse the model's JSON reply into {category: feedback}.
+def parse_review(content, categories):
+    try:
+        parsed = json.loads(content)
+    except json.JSONDecodeError:
+        parsed = None
+    if not isinstance(parsed, dict):
+        return split_feedback_by_category(content, categories)
+    return {
+        category: format_feedback(parsed.get(category, "No feedback returned for this category."))
+        for category in categories
+    }
+
+# -------------------------------
+# Static Analysis Prefilter
+# -------------------------------
+
+def parse_bandit_output(output):
+    report = orjson.loads(output)
+    # Files bandit could not parse are listed under "errors" with empty "results".
+    if report.get("errors"):
+        raise ValueError("bandit reported errors")
+    return [
+        f"line {result['line_number']}: {result['issue_text']} ({result['test_id']})"
+        for result in report["results"]
+    ]
+
+def parse_clang_tidy_output(output):
+    return [line for line in output.splitlines() if ": warning: " in line or ": error: " in line]
+
+# Cheap static analyzers run before the model, keyed by (language, category). Each entry is a
+# command template ({file} is replaced by the file path), the exit codes of a successful run and a
+# parser turning stdout into findings. Any other exit code means the file was not analyzed.
+# The analyzers cover only part of each category's rules, so their findings are passed to the
+# model as extra context; a clean result never replaces the model's review of the category.
+CATEGORY_ANALYZERS = {
+    ("Python", "Security"): (
+        ["bandit", "-f", "json", "-q", "{file}"],
+        # 0: no findings, 1: findings.
+        {0, 1},
+        parse_bandit_output,
+    ),
+}
+
+# clang-tidy needs the project's compile flags (include paths, defines) to analyze real sources, so
+# it reads them from the compilation database in REPO_PATH and is only registered when one exists.
+if os.path.exists(os.path.join(REPO_PATH, "compile_commands.json")):
+    CATEGORY_ANALYZERS[("C++", "Memory Safety")] = (
+        ["clang-tidy", "--quiet", "-p", REPO_PATH,
+         "--checks=-*,clang-analyzer-cplusplus.NewDelete*,clang-analyzer-unix.Malloc,cppcoreguidelines-owning-memory",
+         "{file}"],
+        # clang-tidy exits non-zero when the file could not be compiled or analyzed.
+        {0},
+        parse_clang_tidy_output,
+    )
+
+# Drop analyzers that are not installed, so no subprocess is spawned for them and the review cache
+# key (which includes the registered analyzers) changes once a tool is installed.
+CATEGORY_ANALYZERS = {
+    key: analyzer for key, analyzer in CATEGORY_ANALYZERS.items() if shutil.which(analyzer[0][0])
+}
+
+# Analyzers are CPU-bound subprocesses, so limit how many run at once.
+analyzer_semaphore = asyncio.Semaphore(os.cpu_count() or 4)
+
+# Run the analyzer for one category; returns a list of findings, or None if it could not run.
+async def run_category_analyzer(language, category, file_path):
+    cmd, ok_exit_codes, parse = CATEGORY_ANALYZERS[(language, category)]
+    async with analyzer_semaphore:
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *[arg.format(file=file_path) for arg in cmd],
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+        except FileNotFoundError:
+            return None
+        stdout, _ = await proc.communicate()
+    if proc.returncode not in ok_exit_codes:
+        return None
+    try:
+        return parse(stdout.decode(errors="replace"))
+    except (ValueError, KeyError):
+        return None
+
+# Run every analyzer registered for the language's categories concurrently.
+async def run_category_analyzers(language, categories, file_path):
+    analyzed = [category for category in categories if (language, category) in CATEGORY_ANALYZERS]
+    results = await asyncio.gather(*(
+        run_category_analyzer(language, category, file_path) for category in analyzed
+    ))
+    return {category: findings for category, findings in zip(analyzed, results) if findings is not None}
+
+# Describe analyzer findings in the user message, after the code so the shared prefix is kept.
+def format_analyzer_findings(findings):
+    sections = [
+        f"{category}:\n" + "\n".join(f"- {item}" for item in items)
+        for category, items in findings.items() if items
+    ]
+    if not sections:
+        return ""
+    return "\n\nStatic analysis findings (explain and rank these):\n" + "\n\n".join(sections)
+
+# Perform AI code review for every category of a given file in a single request.
+# size is the file size recorded by the directory walk.
+async def ai_code_review_by_category(file_path, size):
+    logger.info("Reviewing %s...", file_path)
     language = detect_language(file_path)
     if language == "Unknown":
         return {"General": "Skipping file (unknown language)."}
@@ -96,88 +330,168 @@ def ai_code_review_by_category(file_path):
     if not language_rules:
         return {"General": "No rules defined for this language."}
     
-    with open(file_path, "r") as f:
-        code_content = f.read()
+    # Oversized files are reported as skipped without being opened.
+    oversized_feedback = {"General": f"Skipping file (larger than {MAX_FILE_BYTES} bytes)."}
+    if size > MAX_FILE_BYTES:
+        return oversized_feedback
+
+    data = await asyncio.to_thread(read_file, file_path)
+    if len(data) > MAX_FILE_BYTES:
+        return oversized_feedback
+    if b"\0" in data:
+        return {"General": "Skipping file (binary content)."}
+    code_content = data.decode("utf-8", errors="replace")
     
-    category_feedback = {}
-    # For each review category (e.g., Memory Safety, Syntax, Security, Performance)
-    for category, rules_list in language_rules.items():
-        formatted_rules = "\n".join([f"- {rule}" for rule in rules_list])
-        prompt = f"""
-Review the following {language} code for **{category}** issues based on following rules and nothing more:
-{formatted_rules}
-
-Code:
-{code_content}
-"""
-        try:
-            response = ollama.chat(
-                model="deepseek-r1:8b",
-                messages=[{"role": "user", "content": prompt}]
-            )
-            feedback = clean_ai_output(response['message']['content'])
-        except Exception as e:
-            feedback = f"Error during review: {str(e)}"
-        category_feedback[category] = feedback
+    # Unchanged files (same model, prompt, analyzers and code) reuse the review from a previous run.
+    cache_key = review_cache_key(language, code_content)
+    if cache_key in REVIEW_CACHE:
+        used_cache[cache_key] = REVIEW_CACHE[cache_key]
+        return REVIEW_CACHE[cache_key]
+
+    # All categories (e.g., Memory Safety, Syntax, Security, Performance) are reviewed in one
+    # prompt so the code is only evaluated by the model once instead of once per category.
+    categories = list(language_rules)
+
+    # Findings from cheap static analyzers are given to the model alongside the code.
+    findings = await run_category_analyzers(language, categories, file_path)
+
+    try:
+        response = await client.chat(
+            model=MODEL,
+            messages=[
+                {"role": "system", "content": SYSTEM_PROMPTS[language]},
+                {"role": "user", "content": code_content + format_analyzer_findings(findings)},
+            ],
+            format="json"
+        )
+        content = clean_ai_output(response['message']['content'])
+    except Exception as e:
+        return {category: f"Error during review: {str(e)}" for category in categories}
+
+    category_feedback = parse_review(content, categories)
+    used_cache[cache_key] = category_feedback
     return category_feedback
 
 # -------------------------------
 # Report Generation
 # -------------------------------
 
-# Generate a Markdown report with separate sections for each file and category.
-def generate_report(reviews):
-    report_path = os.path.join(REPO_PATH, "code_review_report.md")
-    with open(report_path, "w") as report:
-        report.write("# Code Review Report\n\n")
-        for file, categories in reviews.items():
-            report.write(f"## File: {os.path.relpath(file, REPO_PATH)}\n\n")
-            for category, feedback in categories.items():
-                report.write(f"### {category} Review\n\n")
-                report.write(feedback)
-                report.write("\n\n")
-    print(f"Report generated: {report_path}")
-    return report_path
+# Append one file's review to the Markdown report, with a separate section for each category.
+# Reviews are written as they complete so results never have to be held in memory.
+def write_review(report, file, category_feedback):
+    report.write(f"## File: {os.path.relpath(file, REPO_PATH)}\n\n")
+    for category, feedback in category_feedback.items():
+        report.write(f"### {category} Review\n\n")
+        report.write(feedback)
+        report.write("\n\n")
+    report.flush()
 
 # -------------------------------
 # Other Functions (Static Analysis, Slack)
 # -------------------------------
 
 def get_latest_code():
-    repo = git.Repo(REPO_PATH)
-    repo.git.pull()
-    print("Pulled latest code.")
+    result = subprocess.run(["git", "-C", REPO_PATH, "pull", "--ff-only"], check=False)
+    if result.returncode != 0:
+        logger.warning("git pull failed with exit code %d; reviewing the current working tree.", result.returncode)
+        return
+    logger.info("Pulled latest code.")
+
+# Static analysis tools to run over the repository (customize as needed).
+STATIC_ANALYSIS_COMMANDS = {
+    "flake8": ["flake8", REPO_PATH],
+    "bandit": ["bandit", "-r", "-q", REPO_PATH],
+    "eslint": ["eslint", REPO_PATH],
+    "clang-tidy": ["clang-tidy", "-p", REPO_PATH],
+}
+
+# Run one static analysis tool, writing its output to a separate log file.
+# Like subprocess.run(check=False), a non-zero exit status is not treated as an error.
+async def run_static_tool(name, cmd):
+    with tempfile.NamedTemporaryFile(prefix=f"{name}-", suffix=".log", delete=False) as log:
+        try:
+            proc = await asyncio.create_subprocess_exec(*cmd, stdout=log, stderr=asyncio.subprocess.STDOUT)
+        except FileNotFoundError:
+            proc = None
+        else:
+            returncode = await proc.wait()
+    if proc is None:
+        # Remove the unused log only after it is closed (an open file cannot be deleted on Windows).
+        os.remove(log.name)
+        logger.warning("%s not found, skipping.", name)
+        return None
+    logger.info("%s finished with exit code %d, output: %s", name, returncode, log.name)
+    return returncode
 
-def run_static_analysis():
-    print("Running static analysis...")
-    # Example: run clang-tidy for C++ code (customize as needed)
-    subprocess.run(["clang-tidy", "-p", REPO_PATH], check=False)
+# Run all static analysis tools concurrently, so wall time is the slowest tool rather than the sum.
+async def run_static_analysis():
+    logger.info("Running static analysis...")
+    await asyncio.gather(*(run_static_tool(name, cmd) for name, cmd in STATIC_ANALYSIS_COMMANDS.items()))
 
 def send_slack_notification(report_path):
     SLACK_WEBHOOK_URL = os.getenv("SLACK_WEBHOOK_URL")
     if not SLACK_WEBHOOK_URL:
-        print("No Slack Webhook URL found, skipping Slack notification.")
+        logger.info("No Slack Webhook URL found, skipping Slack notification.")
         return
     message = f"Code Review Completed! Report available at: {report_path}"
-    subprocess.run(["curl", "-X", "POST", "-H", "Content-type: application/json",
-                    "--data", f'{{"text": "{message}"}}', SLACK_WEBHOOK_URL])
+    request = urllib.request.Request(
+        SLACK_WEBHOOK_URL,
+        data=json.dumps({"text": message}).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=5):
+            pass
+    except OSError as e:
+        logger.error("Failed to send Slack notification: %s", e)
 
 # -------------------------------
 # Main Execution
 # -------------------------------
 
-if __name__ == "__main__":
-    get_latest_code()
-    # run_static_analysis()
+# Take groups of identical files from pending one at a time, review each through its first
+# member and write the result to the report before taking the next group.
+async def review_worker(pending, report):
+    while pending:
+        group, size = pending.popleft()
+        category_feedback = await ai_code_review_by_category(group[0], size)
+        for file in group:
+            logger.info("=== %s ===", file)
+            for category, feedback in category_feedback.items():
+                logger.info("--- %s Review ---\n%s\n", category, feedback)
+            write_review(report, file, category_feedback)
 
+# Review files with REVIEW_CONCURRENCY workers; each unique file content is an independent
+# Ollama request. Only the files currently being worked on are read and held in memory.
+async def main():
     files_to_review = get_all_files()
-    reviews = {}
-    for file in files_to_review:
-        print(f"Reviewing {file}...")
-        category_feedback = ai_code_review_by_category(file)
-        reviews[file] = category_feedback
-        for category, feedback in category_feedback.items():
-            print(f"--- {category} Review ---\n{feedback}\n")
-    
-    report_path = generate_report(reviews)
-    # send_slack_notification(report_path)
+    pending = collections.deque(group_identical_files(files_to_review))
+    report_path = os.path.join(REPO_PATH, "code_review_report.md")
+    try:
+        with open(report_path, "w") as report:
+            report.write("# Code Review Report\n\n")
+            await asyncio.gather(*(review_worker(pending, report) for _ in range(REVIEW_CONCURRENCY)))
+    finally:
+        # ollama.AsyncClient has no close() of its own; close its underlying httpx client.
+        await client._client.aclose()
+    save_cache(used_cache)
+    logger.info("Report generated: %s", report_path)
+    return report_path
+
+if __name__ == "__main__":
+    # Concurrent workers only enqueue log records; a single listener thread writes them to stderr,
+    # so coroutines never block on terminal output.
+    log_queue = queue.SimpleQueue()
+    # Only this script logs at INFO; libraries such as httpx stay at the root logger's WARNING.
+    logging.basicConfig(format="%(message)s", handlers=[QueueHandler(log_queue)])
+    logger.setLevel(logging.INFO)
+    log_listener = QueueListener(log_queue, logging.StreamHandler())
+    log_listener.start()
+    try:
+        get_latest_code()
+        # asyncio.run(run_static_analysis())
+
+        report_path = asyncio.run(main())
+        # send_slack_notification(report_path)
+    finally:
+        log_listener.stop()